@@ -47,6 +47,12 @@ def extend_llm_cfg(cfg):
     # ---------------------------------------------------------------------- #
     cfg.llm.cache = CN()
     cfg.llm.cache.model = ''
+    # Compress the cached datasets (JSONL and tokenized pickles) with zstd,
+    # which requires `zstandard`
+    cfg.llm.cache.compress = False
+    # Store the token ids of the cached datasets in memory-mapped `.npy`
+    # files, so that only the accessed samples are loaded into memory
+    cfg.llm.cache.mmap = False
 
     # ---------------------------------------------------------------------- #
     # Chat tools for LLM
@@ -54,6 +60,23 @@ def extend_llm_cfg(cfg):
     cfg.llm.chat = CN()
     cfg.llm.chat.max_history_len = 10
     cfg.llm.chat.max_len = 100
+    # Decoding strategy of the chatbot (greedy search by default)
+    cfg.llm.chat.do_sample = False
+    cfg.llm.chat.num_beams = 1
+    cfg.llm.chat.temperature = 0.7  # Used when `do_sample` is True
+    cfg.llm.chat.top_p = 0.9  # Used when `do_sample` is True
+    # Block repeated n-grams of this size (0 to disable), which also applies
+    # to the offsite-tuning data generation of `ArtifactDataset`
+    cfg.llm.chat.no_repeat_ngram_size = 2
+    cfg.llm.chat.early_stopping = True  # Used when `num_beams` > 1
+    # Wrap the inference model with `torch.compile`, which retraces for the
+    # varying prompt lengths of `generate`
+    cfg.llm.chat.compile = False
+    # The dtype of the inference model weights, e.g., `bfloat16` or `float32`
+    cfg.llm.chat.dtype = 'bfloat16'
+    # Reuse the KV cache of the prefix shared by a batch of prompts in
+    # `generate` (only for the models supporting the transformers Cache)
+    cfg.llm.chat.share_prefix = False
 
     # ---------------------------------------------------------------------- #
     # Deepspeed related options
@@ -23,13 +23,19 @@ class MetaSplitter(BaseSplitter):
     def __call__(self, dataset, prior=None, **kwargs):
         from torch.utils.data import Dataset, Subset
 
-        tmp_dataset = [ds for ds in dataset]
-        if isinstance(tmp_dataset[0], tuple):
-            label = np.array([y for x, y in tmp_dataset])
-        elif isinstance(tmp_dataset[0], dict):
-            label = np.array([x['categories'] for x in tmp_dataset])
+        if hasattr(dataset, 'categories'):
+            # LLM datasets keep the categories aside, so the samples (e.g.,
+            # memory-mapped token ids) are not read to split them
+            label = np.array(dataset.categories)
         else:
-            raise TypeError(f'Unsupported data formats {type(tmp_dataset[0])}')
+            tmp_dataset = [ds for ds in dataset]
+            if isinstance(tmp_dataset[0], tuple):
+                label = np.array([y for x, y in tmp_dataset])
+            elif isinstance(tmp_dataset[0], dict):
+                label = np.array([x['categories'] for x in tmp_dataset])
+            else:
+                raise TypeError(
+                    f'Unsupported data formats {type(tmp_dataset[0])}')
 
         # Split by categories
         categories = set(label)
@@ -1,5 +1,7 @@
+import io
 import os
 import gzip
+import functools
 import json
 import pickle
 import random
@@ -10,6 +12,16 @@ import transformers
 from transformers import GenerationConfig
 from tqdm import tqdm
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 from dataclasses import dataclass
 from federatedscope.llm.dataset.llm_dataset import DefaultToken, \
     LLMDataset, PROMPT_DICT
@@ -110,16 +122,18 @@ class Generator:
         return response_tokens
 
 
+# Reuse the tokenizer (and the number of the added special tokens) instead
+# of re-instantiating it every time a model or a dataset is built
+@functools.lru_cache(maxsize=4)
 def get_tokenizer(model_name, cache_dir, tok_len=128, padding_side="right"):
-    from transformers import AutoTokenizer, GPT2Tokenizer
+    from transformers import AutoTokenizer, GPT2TokenizerFast
 
     if model_name == 'CarperAI/openai_summarize_tldr_sft':
-        tokenizer = GPT2Tokenizer.from_pretrained(
+        tokenizer = GPT2TokenizerFast.from_pretrained(
             'gpt2',
             cache_dir=cache_dir,
             model_max_length=tok_len,
             padding_side=padding_side,
-            use_fast=False,
         )
     else:
         tokenizer = AutoTokenizer.from_pretrained(
@@ -127,7 +141,7 @@ def get_tokenizer(model_name, cache_dir, tok_len=128, padding_side="right"):
             cache_dir=cache_dir,
             model_max_length=tok_len,
             padding_side=padding_side,
-            use_fast=False,
+            use_fast=True,
         )
 
     special_tokens = dict()
@@ -185,6 +199,52 @@ class new_dict(dict):
                 self.dict[prefix][suffix] = __value
 
 
+def zstd_open(file_path, mode='rb'):
+    """
+    Open a zstd-compressed file as a binary stream, similar to `gzip.open`.
+    The long-distance matching window exploits the prompt boilerplate that
+    repeats across the samples.
+    """
+    if zstandard is None:
+        raise ImportError('`zstandard` is required to read or write the '
+                          'compressed caches, please `pip install '
+                          'zstandard` or set `llm.cache.compress` to False.')
+    if 'w' in mode:
+        params = zstandard.ZstdCompressionParameters.from_level(
+            3, window_log=27, enable_ldm=True)
+        cctx = zstandard.ZstdCompressor(compression_params=params)
+        return cctx.stream_writer(open(file_path, 'wb'))
+    dctx = zstandard.ZstdDecompressor(max_window_size=1 << 27)
+    return io.BufferedReader(dctx.stream_reader(open(file_path, 'rb')))
+
+
+def get_cache_token_name(tokenizer):
+    # The prefix of the tokenized dataset caches, which depends on the
+    # tokenizer kind since fast and slow tokenizers may disagree
+    token_name = os.path.basename(tokenizer.name_or_path)
+    if tokenizer.is_fast:
+        token_name += '_fast'
+    return token_name
+
+
+def get_cache_paths(data_root,
+                    tokenizer,
+                    num_clients=None,
+                    suffix='',
+                    compress=False,
+                    mmap=False):
+    # The paths of the tokenized (train, val, test) datasets
+    token_name = get_cache_token_name(tokenizer)
+    ext = '.pickle.zst' if compress else '.pickle'
+    if mmap:
+        ext = '.mmap' + ext
+    train_suffix = suffix if num_clients is None else \
+        f'{suffix}_{num_clients}'
+    return (os.path.join(data_root, f'{token_name}_train{train_suffix}{ext}'),
+            os.path.join(data_root, f'{token_name}_val{suffix}{ext}'),
+            os.path.join(data_root, f'{token_name}_test{suffix}{ext}'))
+
+
 def load_json(file_path,
               instruction='instruction',
               input='input',
@@ -219,10 +279,16 @@ def load_jsonl(file_path,
     # Format of each line:
     # {'instruction': ..., 'input': ..., 'output':...}
     list_data_dict = []
-    open_func = open if not is_gzip else gzip.open
-    with open_func(file_path, 'r') as f:
+    if is_gzip:
+        open_func = gzip.open
+    elif file_path.endswith('.zst'):
+        open_func = zstd_open
+    else:
+        open_func = open
+    loads = orjson.loads if orjson is not None else json.loads
+    with open_func(file_path, 'rb') as f:
         for line in f:
-            item = new_dict(json.loads(line))
+            item = new_dict(loads(line))
             new_item = dict(instruction=item[instruction],
                             input=item[input],
                             output=item[output],
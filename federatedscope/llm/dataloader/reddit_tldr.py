@@ -4,7 +4,8 @@ import copy
 import pickle
 
 from federatedscope.core.data.utils import download_url
-from federatedscope.llm.dataloader.dataloader import load_jsonls, load_jsonl
+from federatedscope.llm.dataloader.dataloader import load_jsonls, \
+    load_jsonl, get_cache_paths
 from federatedscope.llm.dataset.llm_dataset import DefaultToken, \
     LLMDataset, LLMComparisonDataset
 
@@ -262,10 +263,8 @@ def load_human_finetuning_dataset(data_root,
 
 
 def load_comparison_dataset(data_root, tokenizer, max_num_test=-1):
-    token_name = os.path.basename(tokenizer.name_or_path)
-    train_set_path = os.path.join(data_root, f'{token_name}_train.pickle')
-    val_set_path = os.path.join(data_root, f'{token_name}_val.pickle')
-    test_set_path = os.path.join(data_root, f'{token_name}_test.pickle')
+    train_set_path, val_set_path, test_set_path = \
+        get_cache_paths(data_root, tokenizer)
     if os.path.exists(train_set_path) and os.path.exists(val_set_path) \
             and os.path.exists(test_set_path):
         with open(train_set_path, 'rb') as f_train, \
@@ -339,11 +338,8 @@ def load_best_dataset(data_root, tokenizer, max_num_test=-1):
 
 
 def load_comparison_dataset_by_choice(data_root, tokenizer, max_num_test=-1):
-    token_name = os.path.basename(tokenizer.name_or_path)
-    train_set_path = os.path.join(data_root,
-                                  f'{token_name}_train_choice.pickle')
-    val_set_path = os.path.join(data_root, f'{token_name}_val_choice.pickle')
-    test_set_path = os.path.join(data_root, f'{token_name}_test_choice.pickle')
+    train_set_path, val_set_path, test_set_path = \
+        get_cache_paths(data_root, tokenizer, suffix='_choice')
     if os.path.exists(train_set_path) and os.path.exists(val_set_path) and \
             os.path.exists(test_set_path):
         with open(train_set_path, 'rb') as f_train, \
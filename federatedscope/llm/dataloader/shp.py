@@ -1,12 +1,22 @@
 import os
-import json
 import copy
+import json
 import pickle
+import multiprocessing
 import datasets
+import numpy as np
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from federatedscope.core.splitters.generic.lda_splitter import LDASplitter
 from federatedscope.core.data.utils import download_url
-from federatedscope.llm.dataloader.dataloader import load_jsonls, load_jsonl
+from federatedscope.llm.dataloader.dataloader import load_jsonls, \
+    load_jsonl, zstd_open, get_cache_token_name, get_cache_paths
 from federatedscope.llm.dataset.llm_dataset import LLMComparisonDataset, \
     LLMDataset
 
@@ -37,11 +47,83 @@ SHP_PROMPT_DICT = {
 }
 
 
-def _download_shp_cmpr(data_root):
+def _open_cache(file_path, mode='rb', compress=False):
+    if compress:
+        return zstd_open(file_path, mode)
+    return open(file_path, mode, buffering=1 << 20)
+
+
+def _dumps_jsonl_record(record):
+    # Serialize one record as a line of JSONL (in bytes)
+    if orjson is not None:
+        return orjson.dumps(record) + b'\n'
+    return f'{json.dumps(record)}\n'.encode('utf-8')
+
+
+_worker_tokenizer = None
+
+
+def _init_token_length_worker(tokenizer):
+    global _worker_tokenizer
+    # Each worker encodes its own shard, so avoid nested Rust threads
+    os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+    _worker_tokenizer = tokenizer
+
+
+def _token_lengths(texts, tokenizer=None):
+    if tokenizer is None:
+        tokenizer = _worker_tokenizer
+    return tokenizer(texts, return_length=True,
+                     return_attention_mask=False)['length']
+
+
+def _get_token_lengths(tokenizer, texts, chunk_size=10000):
+    # A fast tokenizer encodes a batch in parallel by itself, but it scales
+    # poorly with more than ~32 threads; shard the texts across processes
+    # (one tokenizer per worker) on larger machines instead
+    num_proc = os.cpu_count() or 1
+    if not tokenizer.is_fast or num_proc <= 32:
+        return _token_lengths(texts, tokenizer)
+
+    chunks = [
+        texts[left:left + chunk_size]
+        for left in range(0, len(texts), chunk_size)
+    ]
+    with multiprocessing.Pool(num_proc,
+                              initializer=_init_token_length_worker,
+                              initargs=(tokenizer, )) as pool:
+        return [
+            length for lengths in pool.map(_token_lengths, chunks)
+            for length in lengths
+        ]
+
+
+def _build_datasets(dataset_cls, list_dicts, tokenizer, **kwargs):
+    # The splits are independent and the fast tokenizer releases the GIL, so
+    # build them concurrently. Each thread gets its own tokenizer since the
+    # Rust tokenizer cannot be shared when truncation is enabled.
+    with ThreadPoolExecutor(max_workers=len(list_dicts)) as executor:
+        futures = [
+            executor.submit(dataset_cls, list_dict, copy.deepcopy(tokenizer),
+                            **kwargs) for list_dict in list_dicts
+        ]
+        return [future.result() for future in futures]
+
+
+def _stream_shp(split, columns):
+    # Stream the rows of one split, instead of materializing all the splits
+    # in memory, and only pull the needed columns
+    return datasets.load_dataset("stanfordnlp/SHP",
+                                 split=split,
+                                 streaming=True).select_columns(columns)
+
+
+def _download_shp_cmpr(data_root, compress=False):
+    ext = '.jsonl.zst' if compress else '.jsonl'
     train_fp, val_fp, test_fp = [
-        os.path.join(data_root, 'shp_cmpr_train.jsonl'),
-        os.path.join(data_root, 'shp_cmpr_val.jsonl'),
-        os.path.join(data_root, 'shp_cmpr_test.jsonl')
+        os.path.join(data_root, f'shp_cmpr_train{ext}'),
+        os.path.join(data_root, f'shp_cmpr_val{ext}'),
+        os.path.join(data_root, f'shp_cmpr_test{ext}')
     ]
 
     dataloader_kwargs = {
@@ -58,7 +140,6 @@ def _download_shp_cmpr(data_root):
         list_test_dict = load_jsonl(test_fp, **dataloader_kwargs)
 
     else:
-        dataset = datasets.load_dataset("stanfordnlp/SHP")
         list_train_dict, list_val_dict, list_test_dict = [], [], []
         tag_fp = {
             'train': (train_fp, list_train_dict),
@@ -66,32 +147,34 @@ def _download_shp_cmpr(data_root):
             'test': (test_fp, list_test_dict)
         }
         for tag, (fp, list_data_dict) in tag_fp.items():
-            file = open(fp, 'w')
-            for hist, ref_A, ref_B, choice, domain in \
-                zip(dataset[tag]['history'],
-                    dataset[tag]['human_ref_A'],
-                    dataset[tag]['human_ref_B'],
-                    dataset[tag]['labels'],
-                    dataset[tag]['domain']):
+            # Write to a temporary file first, so that an interrupted
+            # download does not leave a truncated split behind
+            file = _open_cache(fp + '.tmp', 'wb', compress)
+            columns = [
+                'history', 'human_ref_A', 'human_ref_B', 'labels', 'domain'
+            ]
+            for row in _stream_shp(tag, columns):
                 record = {
-                    'instruction': hist,
-                    'output_A': ref_A,
-                    'output_B': ref_B,
-                    'choice': choice,
-                    'category': domain.split('_')[0]
+                    'instruction': row['history'],
+                    'output_A': row['human_ref_A'],
+                    'output_B': row['human_ref_B'],
+                    'choice': row['labels'],
+                    'category': row['domain'].split('_')[0]
                 }
-                file.write(f'{json.dumps(record)}\n')
+                file.write(_dumps_jsonl_record(record))
                 list_data_dict.append(record)
             file.close()
+            os.replace(fp + '.tmp', fp)
 
     return list_train_dict, list_val_dict, list_test_dict
 
 
-def _download_shp(data_root):
+def _download_shp(data_root, compress=False):
+    ext = '.jsonl.zst' if compress else '.jsonl'
     train_fp, val_fp, test_fp = [
-        os.path.join(data_root, 'shp_rlhf_train.jsonl'),
-        os.path.join(data_root, 'shp_rlhf_val.jsonl'),
-        os.path.join(data_root, 'shp_rlhf_test.jsonl')
+        os.path.join(data_root, f'shp_rlhf_train{ext}'),
+        os.path.join(data_root, f'shp_rlhf_val{ext}'),
+        os.path.join(data_root, f'shp_rlhf_test{ext}')
     ]
 
     dataloader_kwargs = {'instruction': 'instruction', 'category': 'category'}
@@ -102,8 +185,7 @@ def _download_shp(data_root):
         list_test_dict = load_jsonl(test_fp, **dataloader_kwargs)
 
     else:
-        dataset = datasets.load_dataset("stanfordnlp/SHP")
-        instructions = []
+        seen_instructions = set()
         list_train_dict, list_val_dict, list_test_dict = [], [], []
         tag_fp = {
             'train': (train_fp, list_train_dict),
@@ -111,28 +193,29 @@ def _download_shp(data_root):
             'test': (test_fp, list_test_dict)
         }
         for tag, (fp, list_data_dict) in tag_fp.items():
-            file = open(fp, 'w')
-            for hist, domain in zip(dataset[tag]['history'],
-                                    dataset[tag]['domain']):
-                if hist not in instructions:
-                    instructions.append(hist)
+            file = _open_cache(fp + '.tmp', 'wb', compress)
+            for row in _stream_shp(tag, ['history', 'domain']):
+                hist, domain = row['history'], row['domain']
+                if hist not in seen_instructions:
+                    seen_instructions.add(hist)
                     record = {
                         'instruction': hist,
                         'category': domain.split('_')[0]
                     }
-                    file.write(f'{json.dumps(record)}\n')
+                    file.write(_dumps_jsonl_record(record))
                     list_data_dict.append(record)
             file.close()
+            os.replace(fp + '.tmp', fp)
 
     return list_train_dict, list_val_dict, list_test_dict
 
 
-def shp_dataset(data_root, num_clients, tokenizer):
+def shp_dataset(data_root, num_clients, tokenizer, compress=False):
     list_train_dict, list_val_dict, list_test_dict = \
-        _download_shp_cmpr(data_root)
+        _download_shp_cmpr(data_root, compress)
 
     # First, disjoint by post instructions
-    list_train_instructions, _, _ = _download_shp(data_root)
+    list_train_instructions, _, _ = _download_shp(data_root, compress)
     cat_idx_map = {}
     for sample in list_train_instructions:
         if sample['category'] not in cat_idx_map:
@@ -154,25 +237,26 @@ def shp_dataset(data_root, num_clients, tokenizer):
             f"Client_{inst_client_map[sample['instruction']]}"
 
     # Select the data with less or equal to 512 tokens
-    new_list_train_dict = []
-    for sample in list_train_dict:
-        len_inst = len(tokenizer(sample['instruction'])['input_ids'])
-        len_resA = len(tokenizer(sample['output_A'])['input_ids'])
-        len_resB = len(tokenizer(sample['output_B'])['input_ids'])
-        if len_inst + len_resA + len_resB <= 512:
-            new_list_train_dict.append(sample)
+    # (tokenize all the texts in one batched call and only keep the lengths)
+    num_samples = len(list_train_dict)
+    texts = [sample['instruction'] for sample in list_train_dict] + \
+        [sample['output_A'] for sample in list_train_dict] + \
+        [sample['output_B'] for sample in list_train_dict]
+    lengths = np.array(_get_token_lengths(tokenizer, texts))
+    mask = lengths[:num_samples] + lengths[num_samples:2 * num_samples] + \
+        lengths[2 * num_samples:] <= 512
+    new_list_train_dict = [
+        sample for sample, keep in zip(list_train_dict, mask) if keep
+    ]
     list_train_dict = new_list_train_dict
 
     # Print the samples of each domain for each clients
+    num_sample_by_domains = defaultdict(Counter)
+    for sample in new_list_train_dict:
+        num_sample_by_domains[sample['category']][sample['domain']] += 1
     for client_id in range(num_clients + 1):
         print(f'Client {client_id}:')
-        num_sample_by_domains = dict()
-        for sample in new_list_train_dict:
-            if sample['category'] == f'Client_{client_id}':
-                if sample['domain'] not in num_sample_by_domains:
-                    num_sample_by_domains[sample['domain']] = 0
-                num_sample_by_domains[sample['domain']] += 1
-        print(num_sample_by_domains)
+        print(dict(num_sample_by_domains[f'Client_{client_id}']))
 
     return list_train_dict, list_val_dict, list_test_dict
 
@@ -180,9 +264,10 @@ def shp_dataset(data_root, num_clients, tokenizer):
 def load_rlhf_dataset(data_root,
                       tokenizer,
                       max_num_test=-1,
-                      raw_no_prompt=False):
+                      raw_no_prompt=False,
+                      compress=False):
     _, list_val_dict, list_test_dict = \
-        _download_shp(data_root)
+        _download_shp(data_root, compress)
 
     # reorganize the training data for RLHF
     list_train_dict = list_val_dict + list_test_dict
@@ -206,45 +291,35 @@ def load_safe_dataset():
 
 
 def load_comparison_dataset(data_root, tokenizer, config, max_num_test=-1):
-    token_name = os.path.basename(tokenizer.name_or_path)
     num_clients = config.federate.client_num
-    train_fp, val_fp, test_fp = [
-        os.path.join(data_root, f'{token_name}_train_{num_clients}.pickle'),
-        os.path.join(data_root, f'{token_name}_val.pickle'),
-        os.path.join(data_root, f'{token_name}_test.pickle')
-    ]
+    compress = config.llm.cache.compress
+    train_fp, val_fp, test_fp = get_cache_paths(data_root,
+                                                tokenizer,
+                                                num_clients,
+                                                compress=compress,
+                                                mmap=config.llm.cache.mmap)
 
     if os.path.exists(train_fp) and os.path.exists(val_fp) and os.path.exists(
             test_fp):
-        with open(train_fp, 'rb') as f_train, open(val_fp, 'rb') as f_val, \
-                open(test_fp, 'rb') as f_test:
+        with _open_cache(train_fp, 'rb', compress) as f_train, \
+                _open_cache(val_fp, 'rb', compress) as f_val, \
+                _open_cache(test_fp, 'rb', compress) as f_test:
             train_dataset = pickle.load(f_train)
             val_dataset = pickle.load(f_val)
             test_dataset = pickle.load(f_test)
+        # The memory-mapped token ids are stored next to the pickles
+        if config.llm.cache.mmap:
+            for split_dataset in [train_dataset, val_dataset, test_dataset]:
+                split_dataset.relocate_mmap(os.path.dirname(train_fp))
 
     else:
         list_train_dict, list_val_dict, list_test_dict = \
-            shp_dataset(data_root, num_clients, tokenizer)
+            shp_dataset(data_root, num_clients, tokenizer, compress)
 
         # load dataset, which should be tuple
-        train_dataset = LLMComparisonDataset(
-            list_train_dict,
-            tokenizer,
-            prompt_input=SHP_PROMPT_DICT['shp'],
-            prompt_no_input=SHP_PROMPT_DICT['shp'],
-            output_A='output_A',
-            output_B='output_B',
-            choice='choice')
-        val_dataset = LLMComparisonDataset(
-            list_val_dict,
-            tokenizer,
-            prompt_input=SHP_PROMPT_DICT['shp'],
-            prompt_no_input=SHP_PROMPT_DICT['shp'],
-            output_A='output_A',
-            output_B='output_B',
-            choice='choice')
-        test_dataset = LLMComparisonDataset(
-            list_test_dict,
+        train_dataset, val_dataset, test_dataset = _build_datasets(
+            LLMComparisonDataset,
+            [list_train_dict, list_val_dict, list_test_dict],
             tokenizer,
             prompt_input=SHP_PROMPT_DICT['shp'],
             prompt_no_input=SHP_PROMPT_DICT['shp'],
@@ -252,10 +327,17 @@ def load_comparison_dataset(data_root, tokenizer, config, max_num_test=-1):
             output_B='output_B',
             choice='choice')
 
+        # Keep the token ids in memory-mapped files next to the pickles
+        if config.llm.cache.mmap:
+            split_datasets = [train_dataset, val_dataset, test_dataset]
+            split_fps = [train_fp, val_fp, test_fp]
+            for split_dataset, fp in zip(split_datasets, split_fps):
+                split_dataset.to_mmap(fp)
+
         # Store these three lists to a pickle file
-        with open(train_fp, 'wb') as f_train, \
-                open(val_fp, 'wb') as f_val, \
-                open(test_fp, 'wb') as f_test:
+        with _open_cache(train_fp, 'wb', compress) as f_train, \
+                _open_cache(val_fp, 'wb', compress) as f_val, \
+                _open_cache(test_fp, 'wb', compress) as f_test:
             pickle.dump(train_dataset, f_train)
             pickle.dump(val_dataset, f_val)
             pickle.dump(test_dataset, f_test)
@@ -289,34 +371,41 @@ def load_shp_cmp_dataset_by_choice(data_root,
                                    tokenizer,
                                    config,
                                    max_num_test=-1):
-    token_name = os.path.basename(tokenizer.name_or_path)
     num_clients = config.federate.client_num
-    train_fp, val_fp, test_fp = [
-        os.path.join(data_root,
-                     f'{token_name}_train_choice_{num_clients}.pickle'),
-        os.path.join(data_root, f'{token_name}_val_choice.pickle'),
-        os.path.join(data_root, f'{token_name}_test_choice.pickle')
-    ]
+    compress = config.llm.cache.compress
+    train_fp, val_fp, test_fp = get_cache_paths(data_root,
+                                                tokenizer,
+                                                num_clients,
+                                                suffix='_choice',
+                                                compress=compress,
+                                                mmap=config.llm.cache.mmap)
 
     if os.path.exists(train_fp) and os.path.exists(val_fp) and os.path.exists(
             test_fp):
-        with open(train_fp, 'rb') as f_train, open(val_fp, 'rb') as f_val, \
-                open(test_fp, 'rb') as f_test:
+        with _open_cache(train_fp, 'rb', compress) as f_train, \
+                _open_cache(val_fp, 'rb', compress) as f_val, \
+                _open_cache(test_fp, 'rb', compress) as f_test:
             train_dataset = pickle.load(f_train)
             val_dataset = pickle.load(f_val)
             test_dataset = pickle.load(f_test)
+        # The memory-mapped token ids are stored next to the pickles
+        if config.llm.cache.mmap:
+            for split_dataset in [train_dataset, val_dataset, test_dataset]:
+                split_dataset.relocate_mmap(os.path.dirname(train_fp))
 
     else:
         list_train_dict, list_val_dict, list_test_dict = \
-            shp_dataset(data_root, num_clients, tokenizer)
+            shp_dataset(data_root, num_clients, tokenizer, compress)
 
         # For training dataset, we should exchange the order
         # and append the new training dataset to the list_train_dict
-        exchange_list_train_dict = copy.deepcopy(list_train_dict)
-        for sample in exchange_list_train_dict:
-            sample['output_A'], sample['output_B'] = \
-                sample['output_B'], sample['output_A']
-            sample['choice'] = 1 - sample['choice']
+        # (shallow copies are enough since only the fields are swapped)
+        exchange_list_train_dict = [
+            dict(sample,
+                 output_A=sample['output_B'],
+                 output_B=sample['output_A'],
+                 choice=1 - sample['choice']) for sample in list_train_dict
+        ]
         list_train_dict = list_train_dict + exchange_list_train_dict
 
         # map the choice to "A" and "B" instead of 0 and 1
@@ -324,26 +413,24 @@ def load_shp_cmp_dataset_by_choice(data_root,
             for sample in list_dict:
                 sample['choice'] = " " + chr(sample['choice'] + ord("A"))
 
-        train_dataset = LLMDataset(list_train_dict,
-                                   tokenizer,
-                                   prompt_input=SHP_PROMPT_DICT['shp_cmp'],
-                                   prompt_no_input=SHP_PROMPT_DICT['shp_cmp'],
-                                   output_tag='choice')
-        val_dataset = LLMDataset(list_val_dict,
-                                 tokenizer,
-                                 prompt_input=SHP_PROMPT_DICT['shp_cmp'],
-                                 prompt_no_input=SHP_PROMPT_DICT['shp_cmp'],
-                                 output_tag='choice')
-        test_dataset = LLMDataset(list_test_dict,
-                                  tokenizer,
-                                  prompt_input=SHP_PROMPT_DICT['shp_cmp'],
-                                  prompt_no_input=SHP_PROMPT_DICT['shp_cmp'],
-                                  output_tag='choice')
+        train_dataset, val_dataset, test_dataset = _build_datasets(
+            LLMDataset, [list_train_dict, list_val_dict, list_test_dict],
+            tokenizer,
+            prompt_input=SHP_PROMPT_DICT['shp_cmp'],
+            prompt_no_input=SHP_PROMPT_DICT['shp_cmp'],
+            output_tag='choice')
+
+        # Keep the token ids in memory-mapped files next to the pickles
+        if config.llm.cache.mmap:
+            split_datasets = [train_dataset, val_dataset, test_dataset]
+            split_fps = [train_fp, val_fp, test_fp]
+            for split_dataset, fp in zip(split_datasets, split_fps):
+                split_dataset.to_mmap(fp)
 
         # Store these three lists to a pickle file
-        with open(train_fp, 'wb') as f_train, \
-                open(val_fp, 'wb') as f_val, \
-                open(test_fp, 'wb') as f_test:
+        with _open_cache(train_fp, 'wb', compress) as f_train, \
+                _open_cache(val_fp, 'wb', compress) as f_val, \
+                _open_cache(test_fp, 'wb', compress) as f_test:
             pickle.dump(train_dataset, f_train)
             pickle.dump(val_dataset, f_val)
             pickle.dump(test_dataset, f_test)
@@ -359,7 +446,7 @@ def load_shp_cmp_dataset_by_choice(data_root,
 
 
 def load_alpacafarm_human_for_eval(data_root, tokenizer):
-    token_name = os.path.basename(tokenizer.name_or_path)
+    token_name = get_cache_token_name(tokenizer)
     path = os.path.join(data_root,
                         f'{token_name}_alpacafarm_human_choice.pickle')
     if os.path.exists(path):
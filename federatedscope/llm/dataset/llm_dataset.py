@@ -3,9 +3,12 @@ Some code snippets are borrowed from the open-sourced stanford_alpaca (
     https://github.com/tatsu-lab/stanford_alpaca)
 """
 
+import os
 import copy
 import logging
+import numpy as np
 import pandas as pd
+import torch
 
 from enum import Enum
 from torch.utils.data import Dataset
@@ -35,6 +38,72 @@ PROMPT_DICT = {
 }
 
 
+class MmapTokenList(object):
+    """
+    A read-only list of 1-D token tensors, which are concatenated in a
+    memory-mapped `.npy` file so that only the accessed samples are paged
+    into memory. Pickling it only stores the file name, the offsets and the
+    absolute directory `root` of the file, which can be changed with
+    `relocate` after unpickling (e.g., to the directory of the pickle).
+    """
+    def __init__(self, filename, offsets, root):
+        self.filename = filename
+        self.offsets = offsets
+        self.root = root
+        self._tokens = None
+
+    @classmethod
+    def create(cls, tensors, path):
+        offsets = np.zeros(len(tensors) + 1, dtype=np.int64)
+        np.cumsum([len(tensor) for tensor in tensors], out=offsets[1:])
+        tokens = np.zeros(offsets[-1], dtype=np.int32)
+        for tensor, start, end in zip(tensors, offsets[:-1], offsets[1:]):
+            tokens[start:end] = np.asarray(tensor)
+        np.save(f'{path}.npy', tokens)
+        return cls(f'{os.path.basename(path)}.npy', offsets,
+                   os.path.dirname(os.path.abspath(path)))
+
+    def relocate(self, root):
+        self.root = root
+        self._tokens = None
+
+    @property
+    def tokens(self):
+        if self._tokens is None:
+            self._tokens = np.load(os.path.join(self.root, self.filename),
+                                   mmap_mode='r')
+        return self._tokens
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            assert step == 1, 'Only contiguous slices are supported.'
+            return MmapTokenList(self.filename,
+                                 self.offsets[start:max(start, stop) + 1],
+                                 self.root)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('MmapTokenList index out of range')
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return torch.from_numpy(self.tokens[start:end].astype(np.int64))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getstate__(self):
+        return dict(filename=self.filename,
+                    offsets=self.offsets,
+                    root=self.root)
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
 # TODO: support LDA when 'category' in keys
 class LLMDataset(Dataset):
     def __init__(self,
@@ -42,7 +111,8 @@ class LLMDataset(Dataset):
                  tokenizer,
                  prompt_input=PROMPT_DICT["prompt_input"],
                  prompt_no_input=PROMPT_DICT["prompt_no_input"],
-                 output_tag='output'):
+                 output_tag='output',
+                 source_offsets=False):
         super(LLMDataset, self).__init__()
 
         # Print prompt info
@@ -67,7 +137,8 @@ class LLMDataset(Dataset):
         #     for example in list_data_dict
         # ]
 
-        data_dict = self.preprocess(self.sources, targets, tokenizer)
+        data_dict = self.preprocess(self.sources, targets, tokenizer,
+                                    source_offsets)
 
         self.input_ids = data_dict["input_ids"]
         self.labels = data_dict["labels"]
@@ -81,22 +152,23 @@ class LLMDataset(Dataset):
         df = pd.DataFrame(categories, columns=["category"])
         self.categories = list(pd.Categorical(df["category"]).codes)
 
-    def _tokenize_fn(self, strings, tokenizer):
-        tokenized_list = [
-            tokenizer(
-                text,
-                return_tensors="pt",
-                padding="longest",
+    def _tokenize_fn(self, strings, tokenizer, batch_size=1000):
+        # Tokenize in batches (no padding is needed since every sample is
+        # kept as an individual tensor)
+        input_ids = []
+        for left in range(0, len(strings), batch_size):
+            tokenized = tokenizer(
+                strings[left:left + batch_size],
                 max_length=tokenizer.model_max_length,
                 truncation=True,
-            ) for text in strings
-        ]
-        input_ids = labels = [
-            tokenized.input_ids[0] for tokenized in tokenized_list
-        ]
+                return_attention_mask=False,
+            )
+            input_ids.extend(
+                torch.tensor(ids, dtype=torch.long)
+                for ids in tokenized.input_ids)
+        labels = input_ids
         input_ids_lens = labels_lens = [
-            tokenized.input_ids.ne(tokenizer.pad_token_id).sum().item()
-            for tokenized in tokenized_list
+            ids.ne(tokenizer.pad_token_id).sum().item() for ids in input_ids
         ]
         return dict(
             input_ids=input_ids,
@@ -105,20 +177,73 @@ class LLMDataset(Dataset):
             labels_lens=labels_lens,
         )
 
-    def preprocess(self, sources, targets, tokenizer):
+    def _tokenize_with_source_lens(self,
+                                   examples,
+                                   sources,
+                                   tokenizer,
+                                   batch_size=1000):
+        # Read the length of each source from the character offsets of its
+        # tokenized example, so that the sources (which are the prefixes of
+        # the examples) are not tokenized a second time
+        input_ids, source_lens = [], []
+        for left in range(0, len(examples), batch_size):
+            tokenized = tokenizer(
+                examples[left:left + batch_size],
+                max_length=tokenizer.model_max_length,
+                truncation=True,
+                return_attention_mask=False,
+                return_offsets_mapping=True,
+            )
+            for ids, offsets, source in zip(tokenized.input_ids,
+                                            tokenized.offset_mapping,
+                                            sources[left:left + batch_size]):
+                # The special tokens added by the tokenizer (e.g., BOS) are
+                # empty spans and belong to the source
+                source_len = 0
+                for start, end in offsets:
+                    if start >= len(source) and (start, end) != (0, 0):
+                        break
+                    source_len += 1
+                input_ids.append(torch.tensor(ids, dtype=torch.long))
+                source_lens.append(source_len)
+        return input_ids, source_lens
+
+    def preprocess(self, sources, targets, tokenizer, source_offsets=False):
+        # With `source_offsets`, the source lengths are read from the offsets
+        # of the fast tokenizer in a single pass instead of tokenizing the
+        # sources again (opt-in: it is not yet checked to give the same
+        # source lengths on every tokenizer, e.g., SentencePiece ones)
         examples = [s + t for s, t in zip(sources, targets)]
-        examples_tokenized, sources_tokenized = [
-            self._tokenize_fn(strings, tokenizer)
-            for strings in (examples, sources)
-        ]
-        input_ids = examples_tokenized["input_ids"]
+        if source_offsets and tokenizer.is_fast:
+            input_ids, source_lens = self._tokenize_with_source_lens(
+                examples, sources, tokenizer)
+        else:
+            examples_tokenized, sources_tokenized = [
+                self._tokenize_fn(strings, tokenizer)
+                for strings in (examples, sources)
+            ]
+            input_ids = examples_tokenized["input_ids"]
+            source_lens = sources_tokenized["input_ids_lens"]
         labels = copy.deepcopy(input_ids)
-        for label, source_len in zip(labels,
-                                     sources_tokenized["input_ids_lens"]):
+        for label, source_len in zip(labels, source_lens):
             label[:source_len] = DefaultToken.IGNORE_INDEX.value
             # TODO: remove the data which is longer than the max input length
         return dict(input_ids=input_ids, labels=labels)
 
+    def to_mmap(self, path):
+        # Move the token ids to memory-mapped files with the prefix `path`,
+        # and drop the prompts, which are only needed by `preprocess`
+        self.input_ids = MmapTokenList.create(self.input_ids,
+                                              f'{path}.input_ids')
+        self.labels = MmapTokenList.create(self.labels, f'{path}.labels')
+        self.sources = None
+
+    def relocate_mmap(self, root):
+        # Look up the memory-mapped token ids in `root`
+        for token_list in (self.input_ids, self.labels):
+            if isinstance(token_list, MmapTokenList):
+                token_list.relocate(root)
+
     def __len__(self):
         return len(self.input_ids)
 
@@ -148,7 +273,8 @@ class LLMComparisonDataset(Dataset):
                  prompt_no_input=PROMPT_DICT["prompt_no_input"],
                  output_A='output_A',
                  output_B='output_B',
-                 choice='choice'):
+                 choice='choice',
+                 source_offsets=False):
         new_list_data_dict = []
         for example in list_data_dict:
             if choice in example and int(example[choice]) == 1:
@@ -164,12 +290,14 @@ class LLMComparisonDataset(Dataset):
                                       tokenizer=tokenizer,
                                       prompt_input=prompt_input,
                                       prompt_no_input=prompt_no_input,
-                                      output_tag=output_A)
+                                      output_tag=output_A,
+                                      source_offsets=source_offsets)
         self.lose_dataset = LLMDataset(list_data_dict=list_data_dict,
                                        tokenizer=tokenizer,
                                        prompt_input=prompt_input,
                                        prompt_no_input=prompt_no_input,
-                                       output_tag=output_B)
+                                       output_tag=output_B,
+                                       source_offsets=source_offsets)
 
         categories = [
             example['category'] if 'category' in example else None
@@ -191,6 +319,14 @@ class LLMComparisonDataset(Dataset):
         # data_dict_B = self.preprocess(self.sources, targets_B, tokenizer)
         # self.lose_labels = data_dict_B["labels"]
 
+    def to_mmap(self, path):
+        self.win_dataset.to_mmap(f'{path}.win')
+        self.lose_dataset.to_mmap(f'{path}.lose')
+
+    def relocate_mmap(self, root):
+        self.win_dataset.relocate_mmap(root)
+        self.lose_dataset.relocate_mmap(root)
+
     def __len__(self):
         return len(self.win_dataset)
 
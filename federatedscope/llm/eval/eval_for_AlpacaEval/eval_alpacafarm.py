@@ -121,7 +121,7 @@ def eval_for_generation(init_cfg, prompt=PROMPT):
                 "datasplit": example["datasplit"]
             }
         record["output"] = fschatbot.generate(PROMPT.format_map(record),
-                                              generate_kwargs)
+                                              generate_kwargs)[0]
         eval_data_dict.append(record)
 
     # save the evaluation result to a file
@@ -65,11 +65,11 @@ def main():
         if record["input"] is None:
             record["output"] = fschatbot.generate(
                 [PROMPT_DICT["prompt_no_input"].format_map(record)],
-                generate_kwargs)
+                generate_kwargs)[0][0]
         else:
             record["output"] = fschatbot.generate(
                 [PROMPT_DICT["prompt_input"].format_map(record)],
-                generate_kwargs)
+                generate_kwargs)[0][0]
         print(record)
         eval_data_dict.append(record)
 
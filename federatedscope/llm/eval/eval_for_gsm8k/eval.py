@@ -215,7 +215,7 @@ def main():
     for sample in testset:
         input_text = build_prompt(sample['instruction'], N_SHOT, COT_FLAG)
         generate_kwargs = dict(max_new_tokens=256, top_p=0.95, temperature=0.8)
-        model_completion = fschatbot.generate(input_text, generate_kwargs)
+        model_completion = fschatbot.generate(input_text, generate_kwargs)[0]
         model_answer = clean_answer(model_completion)
         is_cor = is_correct(model_answer, sample['output'])
         answers.append(is_cor)
@@ -230,7 +230,10 @@ def main():
             for sample in samples
         ]
         generate_kwargs = dict(max_new_tokens=256, top_p=0.95, temperature=0.8)
-        responses = fschatbot.generate(input_texts, generate_kwargs)
+        responses = [
+            completions[0]
+            for completions in fschatbot.generate(input_texts, generate_kwargs)
+        ]
         for (input_text, sample, model_completion) in \
                 zip(input_texts, samples, responses):
             model_answer = clean_answer(model_completion)
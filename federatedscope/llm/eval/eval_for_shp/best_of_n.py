@@ -33,7 +33,8 @@ def _generate_best_of_n_dataset(gen_cfg, n=16):
 
     # get SHP test prompt
     _, _, list_data_dict = \
-        _download_shp(os.path.join(gen_cfg.data.root, 'shp'))
+        _download_shp(os.path.join(gen_cfg.data.root, 'shp'),
+                      gen_cfg.llm.cache.compress)
 
     prompt = SHP_PROMPT_DICT["shp"]
 
@@ -37,7 +37,8 @@ def main():
 
     # get SHP test prompt
     _, _, list_data_dict = \
-        _download_shp(os.path.join(init_cfg.data.root, 'shp'))
+        _download_shp(os.path.join(init_cfg.data.root, 'shp'),
+                      init_cfg.llm.cache.compress)
 
     prompt = SHP_PROMPT_DICT["shp"]
 
@@ -54,11 +55,12 @@ def main():
                 do_sample=False,
                 max_new_tokens=init_cfg.llm.max_new_token,
             )
-            model_completions = fschatbot.generate(input_text, generate_kwargs)
+            model_completion = fschatbot.generate(input_text,
+                                                  generate_kwargs)[0]
 
             results_display.write(
                 f'Instruction:\n{sample["instruction"]}\n\n'
-                f'Model-generated response [[0]]:\n{model_completions}\n\n')
+                f'Model-generated response [[0]]:\n{model_completion}\n\n')
 
             results_display.write('==========================\n\n')
             results_display.flush()
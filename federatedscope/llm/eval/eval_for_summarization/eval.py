@@ -66,14 +66,15 @@ def main():
                 do_sample=False,
                 max_new_tokens=init_cfg.llm.max_new_token,
             )
-            model_completions = fschatbot.generate(input_text, generate_kwargs)
+            model_completion = fschatbot.generate(input_text,
+                                                  generate_kwargs)[0]
 
             results_display.write(
                 f'Subreddit: r/{sample["subreddit"]}\n\n'
                 f'Title:\n{sample["title"]}\n\n'
                 f'Post:\n{sample["post"]}\n\n'
                 f'Human summary:\n{sample["summary"]}\n\n'
-                f'Model-generated summary 0:\n{model_completions}\n\n')
+                f'Model-generated summary 0:\n{model_completion}\n\n')
 
             results_display.write('==========================\n\n')
             results_display.flush()
@@ -3,6 +3,7 @@ import os
 from tqdm import tqdm
 import json
 import argparse
+import multiprocessing
 from rouge_score import rouge_scorer, scoring
 
 from federatedscope.core.configs.config import global_cfg
@@ -10,19 +11,36 @@ from federatedscope.core.cmd_args import parse_args, parse_client_cfg
 from federatedscope.core.auxiliaries.utils import setup_seed
 from federatedscope.core.auxiliaries.logging import update_logger
 from federatedscope.core.data.utils import download_url
-from federatedscope.llm.model.model_builder import get_llm
+from federatedscope.llm.model.model_builder import get_llm, load_checkpoint
 from federatedscope.llm.dataloader.dataloader import load_jsonl, get_tokenizer
 from federatedscope.llm.dataloader.reddit_tldr import TLDR_PROMPT_DICT
 from federatedscope.llm.misc.fschat import FSChatBot
 from federatedscope.llm.eval.eval_for_tldr.best_of_n import \
     best_of_n, best_of_n_multilora
 
+# The number of prompts generated (and scored) at a time
+BATCH_SIZE = 20
 
-def get_input_data(list_data_dict, w=20):
+
+def get_input_data(list_data_dict, w=BATCH_SIZE):
     for left in tqdm(range(0, len(list_data_dict), w)):
         yield list_data_dict[left:left + w]
 
 
+_rouge_scorer = None
+
+
+def _init_rouge_worker():
+    global _rouge_scorer
+    # Calculate ROUGE-L, ROUGE-1, ROUGE-2
+    _rouge_scorer = rouge_scorer.RougeScorer(
+        ['rouge1', 'rouge2', 'rougeL', 'rougeLsum'], use_stemmer=True)
+
+
+def _rouge_score(summary_completion):
+    return _rouge_scorer.score(*summary_completion)
+
+
 def selector_choice(selector, tokenizer, sample):
     dataset = [{
         'subreddit': sample['subreddit'],
@@ -55,7 +73,7 @@ def get_selector_tokenizer(selector_cfg):
         print(os.path.join(dirname, pre + filename))
         if os.path.exists(os.path.join(dirname, pre + filename)):
             ckpt_path = os.path.join(dirname, pre + filename)
-            ckpt = torch.load(ckpt_path, map_location='cpu')
+            ckpt = load_checkpoint(ckpt_path)
             model.load_state_dict(ckpt['model'])
             print(f'Model of Round {ckpt["cur_round"]} loads '
                   f'from the checkpoint {ckpt_path}')
@@ -87,102 +105,131 @@ def main():
     update_logger(init_cfg, clear_before_add=True)
     setup_seed(init_cfg.seed)
 
-    if selector_args.selector_cfg_file:
-        # Load the generation config
-        selector_cfg = init_cfg.clone()
-        selector_cfg.merge_from_file(selector_args.selector_cfg_file)
-        selector_cfg.freeze(save=False)
-        selector, tokenizer = get_selector_tokenizer(selector_cfg)
-    else:
-        selector, tokenizer = None, None
-
-    init_cfg.freeze()
-
-    # load your finetuned model (saved as xxx.ckpt)
-    #    in yaml file federate.save_to
-    fschatbot = FSChatBot(init_cfg)
-
-    # Get test file
-    fp = os.path.join(init_cfg.data.root, 'reddit-tldr_test.jsonl')
-    if not os.path.exists(fp):
-        download_url(
-            'https://openaipublic.blob.core.windows.net/'
-            'summarize-from-feedback/datasets/'
-            'tldr_3_filtered/test.jsonl', init_cfg.data.root)
-        os.rename(os.path.join(init_cfg.data.root, 'test.jsonl'), fp)
-
-    list_data_dict = load_jsonl(fp,
-                                subreddit='subreddit',
-                                title='title',
-                                post='post',
-                                summary='summary')
-
-    prompt = TLDR_PROMPT_DICT["summary"]
-
-    try:
-        results_display = os.path.join(
-            init_cfg.outdir, f'{fschatbot.curpfx}_summarization.txt')
-        results_display = open(results_display, 'w')
-        # Calculate ROUGE-L, ROUGE-1, ROUGE-2
-        scorer = rouge_scorer.RougeScorer(
-            ['rouge1', 'rouge2', 'rougeL', 'rougeLsum'], use_stemmer=True)
-        scores, aggregator = [], scoring.BootstrapAggregator()
-        selector_preferences = []
-
-        for input_data in get_input_data(list_data_dict):
-            input_texts = [prompt.format_map(data) for data in input_data]
-            # generation_config = GenerationConfig(
-            #     temperature=0.6,
-            #     early_stopping=True,
-            #     num_beams=2,
-            #     no_repeat_ngram_size=2,
-            #     do_sample=True,
-            # )
-            generate_kwargs = dict(
-                top_p=1.0,
-                temperature=0.0,
-                do_sample=False,
-                max_new_tokens=init_cfg.llm.max_new_token,
-            )
-            model_completions = fschatbot.generate(input_texts,
-                                                   generate_kwargs)
-
-            for i, sample in enumerate(input_data):
-                sample["completion"] = model_completions[i][0]
-                score = scorer.score(sample["summary"], sample["completion"])
-                sample["score"] = score
-
-                results_display.write(
-                    f'Subreddit: r/{sample["subreddit"]}\n\n'
-                    f'Title:\n{sample["title"]}\n\n'
-                    f'Post:\n{sample["post"]}\n\n'
-                    f'Human summary:\n{sample["summary"]}\n\n'
-                    f'Model-generated summary 0:\n{sample["completion"]}\n\n'
-                    f'Score:\n{sample["score"]}\n\n')
-                if selector:
-                    choice = selector_choice(selector, tokenizer, sample)
-                    results_display.write(f'Selector choice:\n{choice}\n\n')
-                    selector_preferences.append(choice)
-
-                scores.append(score)
-                aggregator.add_scores(score)
-
-                results_display.write('==========================\n\n')
+    # ROUGE is scored in worker processes while the GPU generates the next
+    # batch (no more workers than the samples of a batch are needed); fork
+    # them before any model is loaded
+    num_proc = min(os.cpu_count() or 1, BATCH_SIZE)
+    with multiprocessing.Pool(num_proc,
+                              initializer=_init_rouge_worker) as scorer_pool:
+        if selector_args.selector_cfg_file:
+            # Load the generation config
+            selector_cfg = init_cfg.clone()
+            selector_cfg.merge_from_file(selector_args.selector_cfg_file)
+            selector_cfg.freeze(save=False)
+            selector, tokenizer = get_selector_tokenizer(selector_cfg)
+        else:
+            selector, tokenizer = None, None
+
+        init_cfg.freeze()
+
+        # load your finetuned model (saved as xxx.ckpt)
+        #    in yaml file federate.save_to
+        fschatbot = FSChatBot(init_cfg)
+
+        # Get test file
+        fp = os.path.join(init_cfg.data.root, 'reddit-tldr_test.jsonl')
+        if not os.path.exists(fp):
+            download_url(
+                'https://openaipublic.blob.core.windows.net/'
+                'summarize-from-feedback/datasets/'
+                'tldr_3_filtered/test.jsonl', init_cfg.data.root)
+            os.rename(os.path.join(init_cfg.data.root, 'test.jsonl'), fp)
+
+        list_data_dict = load_jsonl(fp,
+                                    subreddit='subreddit',
+                                    title='title',
+                                    post='post',
+                                    summary='summary')
+
+        prompt = TLDR_PROMPT_DICT["summary"]
+        # The instruction before the first field is shared by all the prompts
+        # (cut at a line break to keep the token boundary stable)
+        shared_prefix = prompt[:prompt.index('{')]
+        shared_prefix = shared_prefix[:shared_prefix.rindex('\n') + 1]
+        generate_kwargs = dict(
+            top_p=1.0,
+            temperature=0.0,
+            do_sample=False,
+            max_new_tokens=init_cfg.llm.max_new_token,
+        )
+
+        try:
+            results_display = os.path.join(
+                init_cfg.outdir, f'{fschatbot.curpfx}_summarization.txt')
+            results_display = open(results_display, 'w', buffering=1 << 20)
+            scores, aggregator = [], scoring.BootstrapAggregator()
+            selector_preferences = []
+
+            def display_batch(input_data, batch_scores):
+                # Write the results of the whole batch at once
+                batch_display = []
+                for sample, score in zip(input_data, batch_scores.get()):
+                    sample["score"] = score
+
+                    batch_display.append(
+                        f'Subreddit: r/{sample["subreddit"]}\n\n'
+                        f'Title:\n{sample["title"]}\n\n'
+                        f'Post:\n{sample["post"]}\n\n'
+                        f'Human summary:\n{sample["summary"]}\n\n'
+                        f'Model-generated summary 0:\n'
+                        f'{sample["completion"]}\n\n'
+                        f'Score:\n{sample["score"]}\n\n')
+                    if selector:
+                        choice = selector_choice(selector, tokenizer, sample)
+                        batch_display.append(f'Selector choice:\n{choice}\n\n')
+                        selector_preferences.append(choice)
+
+                    scores.append(score)
+                    aggregator.add_scores(score)
+
+                    batch_display.append('==========================\n\n')
+                results_display.write(''.join(batch_display))
                 results_display.flush()
 
-        # dump the result to a json file
-        json.dump(
-            list_data_dict,
-            open(os.path.join(init_cfg.outdir, 'summarization.json'), 'w'))
-
-        result = aggregator.aggregate()
-        results_display.write(json.dumps(result) + "\n")
-        selector_win_rate = sum(selector_preferences) / len(
-            selector_preferences)
-        results_display.write(f"Selector win rate: {selector_win_rate*100}%")
-
-    except Exception as err:
-        print(f'{err}, so finished all evaluations....')
+            # The previous batch, whose scores are computed in the background
+            prev_batch = None
+            for input_data in get_input_data(list_data_dict):
+                input_texts = list(map(prompt.format_map, input_data))
+                # generation_config = GenerationConfig(
+                #     temperature=0.6,
+                #     early_stopping=True,
+                #     num_beams=2,
+                #     no_repeat_ngram_size=2,
+                #     do_sample=True,
+                # )
+                model_completions = fschatbot.generate(
+                    input_texts, generate_kwargs, shared_prefix=shared_prefix)
+
+                for i, sample in enumerate(input_data):
+                    sample["completion"] = model_completions[i][0]
+                summary_completions = [(sample["summary"],
+                                        sample["completion"])
+                                       for sample in input_data]
+                batch_scores = scorer_pool.map_async(_rouge_score,
+                                                     summary_completions)
+
+                if prev_batch is not None:
+                    display_batch(*prev_batch)
+                prev_batch = (input_data, batch_scores)
+
+            if prev_batch is not None:
+                display_batch(*prev_batch)
+
+            # dump the result to a json file
+            json.dump(
+                list_data_dict,
+                open(os.path.join(init_cfg.outdir, 'summarization.json'), 'w'))
+
+            result = aggregator.aggregate()
+            results_display.write(json.dumps(result) + "\n")
+            results_display.flush()
+            selector_win_rate = sum(selector_preferences) / len(
+                selector_preferences)
+            results_display.write(
+                f"Selector win rate: {selector_win_rate*100}%")
+
+        except Exception as err:
+            print(f'{err}, so finished all evaluations....')
 
 
 if __name__ == "__main__":
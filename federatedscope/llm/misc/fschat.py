@@ -2,15 +2,16 @@ import sys
 import logging
 import torch
 import transformers
-from transformers import pipeline, GenerationConfig
+from transformers import GenerationConfig
 import os
 import gc
+import functools
 
 transformers.logging.set_verbosity(40)
 
 from federatedscope.core.configs.config import global_cfg
 from federatedscope.core.cmd_args import parse_args, parse_client_cfg
-from federatedscope.llm.model.model_builder import get_llm
+from federatedscope.llm.model.model_builder import get_llm, load_checkpoint
 from federatedscope.llm.dataset.llm_dataset import PROMPT_DICT, DefaultToken
 from federatedscope.core.auxiliaries.utils import setup_seed
 from federatedscope.core.auxiliaries.logging import update_logger
@@ -20,6 +21,7 @@ from federatedscope.llm.offsite_tuning.utils import \
 logger = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=4)
 def get_tokenizer(model_name, cache_dir, tok_len=128):
     from transformers import AutoTokenizer
 
@@ -28,7 +30,7 @@ def get_tokenizer(model_name, cache_dir, tok_len=128):
         cache_dir=cache_dir,
         model_max_length=tok_len,
         padding_side="left",
-        use_fast=False,
+        use_fast=True,
     )
 
     special_tokens = dict()
@@ -75,14 +77,15 @@ class FSChatBot(object):
                                           self.config.llm.tok_len)
 
         self.model = get_llm(self.config, device_map='auto')
+        self.model = self.model.to(
+            dtype=getattr(torch, self.config.llm.chat.dtype))
 
         logger.info("will use raw model.")
         print("will use raw model.")
 
         self.model = self.model.to(self.device + 1)
         self.model = self.model.eval()
-        if torch.__version__ >= "2" and sys.platform != "win32":
-            self.model = torch.compile(self.model)
+        self._prepare_for_inference()
 
         self.max_history_len = self.config.llm.chat.max_history_len
         self.max_len = self.config.llm.chat.max_len
@@ -98,6 +101,10 @@ class FSChatBot(object):
                                           self.config.llm.tok_len)
 
         self.model = get_llm(self.config, device_map='auto')
+        # Cast before loading the checkpoint (`load_state_dict` copies into
+        # the casted weights) and moving to the GPU
+        self.model = self.model.to(
+            dtype=getattr(torch, self.config.llm.chat.dtype))
         self.generation_config = GenerationConfig.from_pretrained(model_name)
         logger.info(f'{model_name} default generation setting: '
                     f'{self.generation_config}')
@@ -115,7 +122,7 @@ class FSChatBot(object):
                 self.model = wrap_offsite_tuning_for_eval(
                     self.model, self.config, ckpt_path)
             else:
-                ckpt = torch.load(ckpt_path, map_location='cpu')
+                ckpt = load_checkpoint(ckpt_path)
                 if 'model' and 'cur_round' in ckpt:
                     self.model.load_state_dict(ckpt['model'])
                     logger.info(
@@ -141,20 +148,34 @@ class FSChatBot(object):
 
         self.model.to('cuda:0')
         self.model = self.model.eval()
-        if torch.__version__ >= "2" and sys.platform != "win32":
-            self.model = torch.compile(self.model)
-
-        # # Create the generation pipeline
-        # self.generation_pipe = pipeline('text-generation',
-        #                                 model=self.model,
-        #                                 tokenizer=self.tokenizer,
-        #                                 device_map='auto',
-        #                                 trust_remote_code='True')
+        self._prepare_for_inference()
 
         self.max_history_len = self.config.llm.chat.max_history_len
         self.max_len = self.config.llm.chat.max_len
         self.history = []
 
+    def _prepare_for_inference(self):
+        self._prefix_cache = None
+        self.model.config.use_cache = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        if self.config.llm.chat.compile and torch.__version__ >= "2" and \
+                sys.platform != "win32":
+            self.model = torch.compile(self.model)
+
+    def _chat_generate_kwargs(self):
+        chat_cfg = self.config.llm.chat
+        generate_kwargs = dict(do_sample=chat_cfg.do_sample,
+                               num_beams=chat_cfg.num_beams)
+        if chat_cfg.do_sample:
+            generate_kwargs.update(temperature=chat_cfg.temperature,
+                                   top_p=chat_cfg.top_p)
+        if chat_cfg.no_repeat_ngram_size > 0:
+            generate_kwargs.update(
+                no_repeat_ngram_size=chat_cfg.no_repeat_ngram_size)
+        if chat_cfg.num_beams > 1:
+            generate_kwargs.update(early_stopping=chat_cfg.early_stopping)
+        return generate_kwargs
+
     def _build_prompt(self, input_text):
         source = {'instruction': input_text}
         return PROMPT_DICT['prompt_no_input'].format_map(source)
@@ -174,10 +195,7 @@ class FSChatBot(object):
         input_ids = input_ids.unsqueeze(0).to(self.device)
         response = self.model.generate(input_ids=input_ids,
                                        max_new_tokens=self.max_len,
-                                       num_beams=4,
-                                       no_repeat_ngram_size=2,
-                                       early_stopping=True,
-                                       temperature=0.2)
+                                       **self._chat_generate_kwargs())
 
         self.history.append(response[0].tolist())
         response_tokens = \
@@ -186,32 +204,149 @@ class FSChatBot(object):
         return response_tokens
 
     @torch.no_grad()
-    def generate(self,
-                 input_texts: list[str],
-                 generate_kwargs={}) -> list[list[str]]:
+    def _get_prefix_cache(self, shared_prefix):
+        # Prefill the KV cache of the shared prefix once and reuse it. A
+        # failure is cached as well, i.e., (None, None) is returned for the
+        # prefix until it changes.
+        if self._prefix_cache is None or \
+                self._prefix_cache[0] != shared_prefix:
+            self._prefix_cache = (shared_prefix, None, None)
+            try:
+                prefix_ids = self.tokenizer(
+                    shared_prefix,
+                    add_special_tokens=True,
+                    return_tensors="pt").input_ids.to("cuda:0")
+                past_key_values = self.model(input_ids=prefix_ids,
+                                             use_cache=True).past_key_values
+                if hasattr(past_key_values, 'to_legacy_cache'):
+                    past_key_values = past_key_values.to_legacy_cache()
+                # Only the (key, value) layout of (batch, heads, seq, dim)
+                # can be repeated for the batch
+                for layer in past_key_values:
+                    if len(layer) != 2 or any(t.dim() != 4 for t in layer):
+                        raise ValueError('Unsupported KV cache layout.')
+                self._prefix_cache = (shared_prefix, prefix_ids[0],
+                                      past_key_values)
+            except Exception as error:
+                logger.warning(
+                    f'{error}, so the prefix KV cache is not shared.')
+        return self._prefix_cache[1:]
+
+    def _share_prefix(self, input_text_tokens, shared_prefix):
+        """
+        Rearrange the left-padded inputs as `[prefix, padding, suffix]` so
+        that the prefix sits at the same positions for every row, and build
+        the prefix KV cache for the batch. Return None if the model does not
+        support it or some prompt does not start with the tokens of the
+        prefix.
+        """
+        try:
+            from transformers import DynamicCache
+        except ImportError:
+            return None
+
+        # Unwrap the AdapterModel (and PeftModel) to the transformers model
+        model = self.model
+        while not isinstance(model, transformers.PreTrainedModel) and \
+                hasattr(model, 'model'):
+            model = model.model
+        if not getattr(model, '_supports_cache_class', False):
+            return None
+
+        prefix_ids, past_key_values = self._get_prefix_cache(shared_prefix)
+        if prefix_ids is None:
+            return None
+        prefix_len = len(prefix_ids)
+        input_ids, attention_mask = [], []
+        for ids, mask in zip(input_text_tokens.input_ids,
+                             input_text_tokens.attention_mask):
+            num_pads = int((mask == 0).sum())
+            if not torch.equal(ids[num_pads:num_pads + prefix_len],
+                               prefix_ids):
+                return None
+            order = torch.cat([
+                torch.arange(num_pads, num_pads + prefix_len),
+                torch.arange(num_pads),
+                torch.arange(num_pads + prefix_len, len(ids))
+            ]).to(ids.device)
+            input_ids.append(ids[order])
+            attention_mask.append(mask[order])
+
+        batch_size = len(input_ids)
+        try:
+            past_key_values = DynamicCache.from_legacy_cache(
+                tuple((key.repeat(batch_size, 1, 1, 1),
+                       value.repeat(batch_size, 1, 1, 1))
+                      for key, value in past_key_values))
+        except Exception as error:
+            logger.warning(f'{error}, so the prefix KV cache is not shared.')
+            return None
+        return dict(input_ids=torch.stack(input_ids),
+                    attention_mask=torch.stack(attention_mask),
+                    past_key_values=past_key_values)
+
+    @torch.no_grad()
+    def generate(self, input_texts, generate_kwargs={}, shared_prefix=None):
+        """
+        Generate completions for a single prompt (`str`) or a batch of
+        prompts (`list[str]`) with one padded forward pass. A single prompt
+        returns its list of completions (`list[str]`, one for each of the
+        `num_return_sequences`); a batch returns one such list per prompt
+        (`list[list[str]]`).
+
+        `shared_prefix` is the text that every prompt starts with, whose KV
+        cache is computed once and reused by all the batches when
+        `llm.chat.share_prefix` is on. It only applies to a single
+        greedy/sampled completion per prompt.
+        """
+        is_single = isinstance(input_texts, str)
+        if is_single:
+            input_texts = [input_texts]
+
         input_text_tokens = self.tokenizer(
             input_texts,
             padding=True,
             add_special_tokens=True,
             return_tensors="pt",
         ).to("cuda:0")
-
-        output_ids = self.model.generate(**input_text_tokens,
-                                         **generate_kwargs)
-        responses = self.tokenizer.batch_decode(output_ids,
-                                                skip_special_tokens=True,
-                                                ignore_tokenization_space=True)
-
-        response_map = [[] for _ in input_texts]
-        for res in responses:
-            for idx, input_text in enumerate(input_texts):
-                if input_text in res:
-                    gen_res = res.replace(input_text, "").strip()
-                    response_map[idx].append(gen_res.replace("</s>", ""))
-                    # response_map[idx].append(
-                    #     " " + gen_res.replace("</s>", ""))
-                    break
-
+        input_len = input_text_tokens.input_ids.shape[1]
+
+        generate_kwargs = {
+            'pad_token_id': self.tokenizer.pad_token_id,
+            **generate_kwargs
+        }
+        model_inputs = None
+        if shared_prefix is not None and \
+                self.config.llm.chat.share_prefix and \
+                'generation_config' not in generate_kwargs and \
+                generate_kwargs.get('num_beams', 1) == 1 and \
+                generate_kwargs.get('num_return_sequences', 1) == 1:
+            model_inputs = self._share_prefix(input_text_tokens, shared_prefix)
+        output_ids = None
+        if model_inputs is not None:
+            try:
+                output_ids = self.model.generate(**model_inputs,
+                                                 **generate_kwargs)
+            except RuntimeError as error:
+                logger.warning(
+                    f'{error}, so regenerate without the prefix KV cache.')
+        if output_ids is None:
+            output_ids = self.model.generate(**input_text_tokens,
+                                             **generate_kwargs)
+        # The tokenizer pads on the left, so every completion starts right
+        # after the (padded) prompt
+        responses = self.tokenizer.batch_decode(output_ids[:, input_len:],
+                                                skip_special_tokens=True)
+
+        # `num_return_sequences` completions are generated for each prompt
+        num_return = len(responses) // len(input_texts)
+        response_map = [[
+            res.strip()
+            for res in responses[idx * num_return:(idx + 1) * num_return]
+        ] for idx in range(len(input_texts))]
+
+        if is_single:
+            return response_map[0]
         return response_map
 
     def clear(self):
@@ -203,8 +203,10 @@ class AdapterModel(nn.Module):
         except RuntimeError as e:
             # When does evaluation in HELM,
             # half precision will cause RuntimeError,
-            # the following solves it
-            if 'do_sample' in kwargs.keys():
+            # the following solves it. A given KV cache has been extended by
+            # the failed call, so it cannot be retried here.
+            if 'do_sample' in kwargs.keys() and \
+                    'past_key_values' not in kwargs.keys():
                 del kwargs['do_sample']
                 if isinstance(self.model, PeftModel) and disable_adapter:
                     with self.model.disable_adapter():
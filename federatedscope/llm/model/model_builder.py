@@ -9,6 +9,22 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+def load_checkpoint(ckpt_path):
+    # Memory-map the checkpoint (torch >= 2.1), so that the tensors are paged
+    # in while `load_state_dict` copies them instead of being read up front
+    try:
+        return torch.load(ckpt_path, map_location='cpu', mmap=True)
+    except TypeError as error:
+        # Older torch without the `mmap` argument
+        if 'mmap' not in str(error):
+            raise
+    except RuntimeError as error:
+        # Checkpoints not in the zipfile format cannot be memory-mapped
+        if 'mmap can only be used with files saved with' not in str(error):
+            raise
+    return torch.load(ckpt_path, map_location='cpu')
+
+
 def get_model_from_huggingface(model_name, config, **kwargs):
     from transformers import AutoModelForCausalLM
 
@@ -1,6 +1,5 @@
 import re
 import torch
-import sys
 import transformers
 import logging
 
@@ -96,8 +95,7 @@ class ArtifactDataset(FSChatBot):
         else:
             self.model.to(self.device)
         self.model = self.model.eval()
-        if torch.__version__ >= "2" and sys.platform != "win32":
-            self.model = torch.compile(self.model)
+        self._prepare_for_inference()
 
         self.max_history_len = config.llm.chat.max_history_len
         self.max_len = config.llm.chat.max_len
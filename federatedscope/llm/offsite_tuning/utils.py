@@ -8,6 +8,7 @@ import torch.nn as nn
 from transformers import (OPTForCausalLM, GPT2LMHeadModel, BloomForCausalLM,
                           LlamaForCausalLM)
 from federatedscope.llm.model.adapter_builder import AdapterModel
+from federatedscope.llm.model.model_builder import load_checkpoint
 from federatedscope.llm.offsite_tuning.kd_trainer import KDTrainer
 from federatedscope.core.auxiliaries.data_builder import get_data
 
@@ -392,7 +393,7 @@ def wrap_offsite_tuning_for_eval(model, config, ckpt_path=None):
     try:
         if ckpt_path is None:
             ckpt_path = config.federate.save_to
-        ckpt = torch.load(ckpt_path, map_location='cpu')
+        ckpt = load_checkpoint(ckpt_path)
         # # Sanity check
         # print('key for the loading model:')
         # print(ckpt['model'].keys())
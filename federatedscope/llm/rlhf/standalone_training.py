@@ -74,9 +74,11 @@ def get_rlhf_prompts_dataset(config):
             load_rlhf_dataset, SHP_PROMPT_DICT
 
         data_root = os.path.join(config.data.root, 'shp')
-        list_train_prompts, _, _ = load_rlhf_dataset(data_root,
-                                                     tokenizer=None,
-                                                     max_num_test=1000)
+        list_train_prompts, _, _ = load_rlhf_dataset(
+            data_root,
+            tokenizer=None,
+            max_num_test=1000,
+            compress=config.llm.cache.compress)
         generation_prompt = SHP_PROMPT_DICT["shp"]
         selector_prompt = SHP_PROMPT_DICT["shp_cmp"]
 
@@ -74,7 +74,9 @@ def get_rlhf_dataset(config):
             load_rlhf_dataset, SHP_PROMPT_DICT
 
         data_root = os.path.join(config.data.root, 'shp')
-        _, val, test = load_rlhf_dataset(data_root, tokenizer=None)
+        _, val, test = load_rlhf_dataset(data_root,
+                                         tokenizer=None,
+                                         compress=config.llm.cache.compress)
         list_train_dict = val + test
         generation_prompt = SHP_PROMPT_DICT["shp"]
         selector_prompt = SHP_PROMPT_DICT["shp_cmp"]